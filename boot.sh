@@ -1,4 +1,7 @@
 #!/bin/sh
 
 # make sure to set LOG_LEVEL in container environment
-exec gunicorn -b :5000 -w 2 --log-level=$LOG_LEVEL --access-logfile - --error-logfile - --worker-tmp-dir /dev/shm 'mvc:create_app()'
+# gevent workers hold the long-lived live update (server-sent events) streams
+# as cheap greenlets instead of tying up one sync worker per open page
+# gunicorn.conf.py makes psycopg2 cooperative with gevent in each worker
+exec gunicorn -c gunicorn.conf.py -b :5000 -w 2 -k gevent --worker-connections 1000 --log-level=$LOG_LEVEL --access-logfile - --error-logfile - --worker-tmp-dir /dev/shm 'mvc:create_app()'
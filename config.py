@@ -18,6 +18,22 @@ class Config(object):
         "SQLALCHEMY_DATABASE_URI"
     ) or "sqlite:///" + os.path.join(basedir, "todos.db")
 
+    # optional comma-separated list of read replica database urls
+    # safe (GET, HEAD, OPTIONS) requests and celery read tasks are routed to a
+    # replica, writes always go to the primary SQLALCHEMY_DATABASE_URI
+    SQLALCHEMY_REPLICA_URIS = [
+        uri.strip()
+        for uri in os.environ.get("SQLALCHEMY_REPLICA_URIS", "").split(",")
+        if uri.strip()
+    ]
+    # replicas are registered as flask_sqlalchemy binds named replica_<n>
+    SQLALCHEMY_BINDS = {
+        f"replica_{i}": uri for i, uri in enumerate(SQLALCHEMY_REPLICA_URIS)
+    }
+    # after a client writes, its reads stay on the primary for this many
+    # seconds so that it sees its own writes despite replication lag
+    DB_REPLICA_STICKY_SECONDS = float(os.environ.get("DB_REPLICA_STICKY_SECONDS", 5))
+
     # enable query sql printout
     SQLALCHEMY_ECHO = True
     # Flask-SQLAlchemy has its own event notification system that gets layered
@@ -32,3 +48,65 @@ class Config(object):
     MAX_CONTENT_LENGTH = 1024 * 1024
     # limit upload file extensions
     UPLOAD_EXTENSIONS = [".jpg", ".png", ".gif"]
+
+    # completed todos not updated for this many days are moved to the
+    # archive table by the `archive_completed_todos` celery beat task
+    TODO_ARCHIVE_AFTER_DAYS = int(os.environ.get("TODO_ARCHIVE_AFTER_DAYS", 30))
+    # number of todos moved per archive transaction, keep it small so that
+    # each batch only holds row locks for a short time
+    TODO_ARCHIVE_BATCH_SIZE = int(os.environ.get("TODO_ARCHIVE_BATCH_SIZE", 200))
+
+    # redis url of the pub/sub bus for live todo updates, for example
+    # "redis://localhost:6379/1", without it events stay in each process
+    EVENT_BUS_URL = os.environ.get("EVENT_BUS_URL")
+    EVENT_BUS_CHANNEL = os.environ.get("EVENT_BUS_CHANNEL", "todos_mvc_events")
+    # seconds between keep-alive comments on idle event streams
+    EVENT_STREAM_HEARTBEAT_SECONDS = 15
+
+    # number of trusted proxies in front of the app that append to the
+    # X-Forwarded-For header, e.g. 1 behind the k8s ingress, 0 when clients
+    # connect directly, in which case the header is ignored
+    PROXY_FIX_X_FOR = int(os.environ.get("PROXY_FIX_X_FOR", 0))
+
+    # admission control and rate limiting, see mvc/ratelimit.py
+    RATELIMIT_ENABLED = os.environ.get("RATELIMIT_ENABLED", "true").lower() == "true"
+    # redis url to share token buckets and counters across workers, for
+    # example "redis://localhost:6379/2", without it each process has its own
+    RATELIMIT_STORAGE_URL = os.environ.get("RATELIMIT_STORAGE_URL")
+    RATELIMIT_KEY_PREFIX = "todos_mvc_ratelimit"
+    # token bucket per client ip and endpoint class:
+    # (tokens refilled per second, bucket size aka burst)
+    RATELIMIT_RULES = {
+        "upload": (0.5, 5),
+        "auth": (0.2, 5),
+        "write": (5, 20),
+        "read": (20, 50),
+    }
+    # max concurrent requests per worker process for expensive endpoint
+    # classes, requests beyond this get a 503 right away instead of queueing
+    RATELIMIT_MAX_IN_FLIGHT = {"upload": 2, "auth": 2}
+
+    # celery broker and result backend, redis by default
+    # to run tasks without redis, e.g. when trying out celery jobs locally,
+    # use broker "memory://", result backend "cache+memory://" and eager mode,
+    # which runs tasks in the calling process
+    CELERY_BROKER_URL = os.environ.get("CELERY_BROKER_URL", "redis://localhost")
+    CELERY_RESULT_BACKEND = os.environ.get("CELERY_RESULT_BACKEND", "redis://localhost")
+    CELERY_TASK_ALWAYS_EAGER = (
+        os.environ.get("CELERY_TASK_ALWAYS_EAGER", "false").lower() == "true"
+    )
+
+    # write-behind for todo title and complete edits through todos.patch,
+    # see mvc/writebehind.py for the durability guarantees before enabling
+    TODO_WRITE_BEHIND = os.environ.get("TODO_WRITE_BEHIND", "false").lower() == "true"
+    # redis url to buffer edits for all workers, for example
+    # "redis://localhost:6379/3", needed with more than one worker process,
+    # without it each process buffers its own edits
+    TODO_WRITE_BEHIND_URL = os.environ.get("TODO_WRITE_BEHIND_URL")
+    TODO_WRITE_BEHIND_KEY_PREFIX = "todos_mvc_write_behind"
+    # seconds between flushes of buffered edits to the db
+    TODO_WRITE_BEHIND_INTERVAL = float(os.environ.get("TODO_WRITE_BEHIND_INTERVAL", 1))
+    # flush early once this many todos have buffered edits
+    TODO_WRITE_BEHIND_MAX_PENDING = int(
+        os.environ.get("TODO_WRITE_BEHIND_MAX_PENDING", 500)
+    )
@@ -0,0 +1,18 @@
+# gunicorn.conf.py
+#
+# gunicorn server hooks, loaded by `boot.sh` with `-c gunicorn.conf.py`.
+# Command line options in `boot.sh` are kept there, this file only holds hooks.
+#
+
+
+def post_fork(server, worker):
+    # gevent monkey patching makes python sockets cooperative, but psycopg2 is
+    # a C extension doing its own socket io, so without a wait callback every
+    # postgres query blocks the whole worker, including all its open live
+    # update streams
+    # psycogreen installs a wait callback that yields to other greenlets
+    if "gevent" in server.cfg.worker_class_str:
+        from psycogreen.gevent import patch_psycopg
+
+        patch_psycopg()
+        server.log.info(f"worker {worker.pid}: psycopg2 patched for gevent")
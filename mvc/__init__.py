@@ -12,6 +12,7 @@ import time
 
 from flask import Flask, g, render_template, request, session
 from flask.helpers import make_response
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 from config import Config
 from mvc.model import User, db
@@ -22,6 +23,11 @@ def create_app(config=Config):
     app = Flask(__name__)
     app.config.from_object(config)
 
+    # behind PROXY_FIX_X_FOR trusted proxies (e.g. the k8s ingress), take the
+    # client ip from the X-Forwarded-For entry the outermost proxy added
+    if app.config["PROXY_FIX_X_FOR"]:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config["PROXY_FIX_X_FOR"])
+
     # setup logging
     # check if flask app is served by gunicorn
     if "gunicorn" in os.environ.get("SERVER_SOFTWARE", ""):
@@ -50,11 +56,19 @@ def create_app(config=Config):
     with app.app_context():
         app.logger.info("sqlalchemy started database sync")
         # for any schema DDL change, need to enable db.drop_all() to reset db
+        # create_all() only creates missing tables, it does not add columns
+        # or indexes to existing ones, a db created before todos had a version
+        # column and archive index (e.g. the compose db-data volume) needs,
+        # without a reset:
+        #   ALTER TABLE todos ADD COLUMN version integer NOT NULL DEFAULT 1;
+        #   CREATE INDEX ix_todos_complete_updated_at ON todos (complete, updated_at);
         # db.drop_all()
         db.create_all()
         app.logger.info("sqlalchemy completed database sync")
 
     # setup background tasks with celery
+    # celery_jobs is imported to register the chunked job tasks
+    from . import celery_jobs
     from .celery_init import celery_init_app
     from .celery_tasks import CELERY_BEAT_SCHEDULE
 
@@ -62,9 +76,12 @@ def create_app(config=Config):
         CELERY=dict(
             # Use redis as the broker for celery
             # "redis://localhost:6379/0"
-            broker_url="redis://localhost",
+            broker_url=app.config["CELERY_BROKER_URL"],
             # set redis as backend to store the task state and return values
-            result_backend="redis://localhost",
+            result_backend=app.config["CELERY_RESULT_BACKEND"],
+            # run tasks in the calling process, for local testing
+            task_always_eager=app.config["CELERY_TASK_ALWAYS_EAGER"],
+            task_eager_propagates=app.config["CELERY_TASK_ALWAYS_EAGER"],
             # set default not to store task state and result in redis, but can
             # override specific tasks to enable it
             task_ignore_result=True,
@@ -79,6 +96,16 @@ def create_app(config=Config):
     celery_init = celery_init_app(app)
     app.logger.info("flask app loaded with celery")
 
+    # setup pub/sub bus for live todo updates
+    from . import events
+
+    events.init_app(app)
+
+    # setup optional write-behind buffer for todo field edits
+    from . import writebehind
+
+    writebehind.init_app(app)
+
     # initialize blueprints
 
     from . import home
@@ -97,8 +124,19 @@ def create_app(config=Config):
 
     app.register_blueprint(auth.bp)
 
+    from . import archive
+
+    app.register_blueprint(archive.bp)
+
     # app.add_url_rule('/', endpoint='index')
 
+    # route safe requests to read replicas, if configured
+    # this must come before other interceptors that query the db
+
+    from . import replicas
+
+    replicas.init_app(app)
+
     # add global logging middleware
 
     # use before_request interceptor to load g context
@@ -108,7 +146,9 @@ def create_app(config=Config):
         app.logger.debug("before_request > get_req_start_time")
 
         # timestamp = rfc3339(dt, utc=True)
-        ip = request.headers.get("X-Forwarded-For", request.remote_addr)
+        # X-Forwarded-For can be forged by the client, remote_addr is the
+        # peer or, with PROXY_FIX_X_FOR set, the client seen by the proxies
+        ip = request.remote_addr
         host = request.host.split(":", 1)[0]
         args = dict((k, request.args.getlist(k)) for k in request.args.keys())
         form = dict((k, request.form.getlist(k)) for k in request.form.keys())
@@ -142,6 +182,13 @@ def create_app(config=Config):
         app.logger.debug(">> request :: " + str(log_details))
 
         g.start = time.time()
+        g.client_ip = ip
+
+    # shed load with rate limits before any interceptor or view hits the db
+
+    from . import ratelimit
+
+    ratelimit.init_app(app)
 
     # we can have multiple interceptors, they are executed in the order
     # they are defined
@@ -185,6 +232,15 @@ def create_app(config=Config):
         # todo: can decorate resp object here
         return resp
 
+    # 409 is returned when an optimistic concurrency version check fails
+
+    @app.errorhandler(409)
+    def err_conflict(error):
+        app.logger.info("server returns 409")
+        app.logger.info(error)
+        resp = make_response(render_template("error409.html", error=error), 409)
+        return resp
+
     @app.errorhandler(500)
     @app.errorhandler(Exception)
     def err_internal_server_error(error):
@@ -0,0 +1,39 @@
+import logging
+
+from flask import Blueprint, flash, redirect, render_template, request, url_for
+from sqlalchemy import desc
+from sqlalchemy.orm import defer
+
+from mvc.model import ArchivedTodo, db, restore_todos
+
+LOG = logging.getLogger(__name__)
+
+
+bp = Blueprint("archive", __name__)
+
+ARCHIVE_PAGE_SIZE = 50
+
+
+@bp.route("/archive", methods=["GET"])
+def index():
+    # the archive grows forever, so always page through it
+    # and never load the image blobs for the listing
+    page = db.paginate(
+        db.select(ArchivedTodo)
+        .options(defer(ArchivedTodo.pic))
+        .order_by(desc(ArchivedTodo.archived_at)),
+        per_page=ARCHIVE_PAGE_SIZE,
+        error_out=False,
+    )
+    return render_template("archive/index.html", page=page, title="Todo App - Archive")
+
+
+@bp.route("/archive/restore/<todo_id>", methods=["POST"])
+def restore(todo_id):
+    restored = restore_todos(db.session, [todo_id])
+    db.session.commit()
+    if restored:
+        flash(f"a todo [{todo_id}] was restored")
+    else:
+        flash(f"no archived todo [{todo_id}] found")
+    return redirect(url_for("archive.index", page=request.args.get("page", 1)))
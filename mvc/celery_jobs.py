@@ -0,0 +1,206 @@
+# celery_jobs.py
+#
+# A framework for chunked, parallel table-wide maintenance jobs, such as
+# re-encoding images, recomputing counters or backfilling columns.
+#
+# A job is a subclass of ChunkedJob registered with @register_job. Running it:
+# - `start_chunked_job` splits the job table's key range into chunks of
+#   `chunk_size` rows, records one JobChunk checkpoint row per chunk, and fans
+#   the chunks out to the workers as a celery chord
+# - each `run_chunk` task processes one key range and marks its checkpoint
+#   done in the same transaction, holding a row lock on the checkpoint, so a
+#   chunk's work is committed exactly when its checkpoint is, and a chunk is
+#   never processed twice, even by two deliveries of the same task at once
+# - `finish_chunked_job` is the chord callback, it logs the rows processed
+#   and rows per second of the run
+# - `resume_chunked_job` re-dispatches the chunks that are not done yet,
+#   after a failure or a worker crash
+#
+# Example, in the flask shell:
+#
+#   from mvc.celery_jobs import start_chunked_job, resume_chunked_job
+#   job_id = start_chunked_job.delay("backfill_todo_complete").get()
+#   resume_chunked_job.delay(job_id)
+#
+
+import logging
+import time
+import uuid
+
+from celery import chord, shared_task
+from sqlalchemy import and_, func, select, update
+
+from .celery_tasks import SqlAlchemyTask, db_session
+from .model import JobChunk, Todo
+
+LOG = logging.getLogger(__name__)
+
+
+class ChunkedJob:
+    """Base class of a table-wide job that is processed in key range chunks.
+
+    Subclasses set `name` and `key_column`, a unique sortable table column
+    such as the primary key, and implement `process_chunk()`.
+    Use the table column, `Model.__table__.c.<name>`, as the orm attribute
+    would act as a descriptor on the job class.
+    """
+
+    name = None
+    key_column = None
+    chunk_size = 500
+
+    def process_chunk(self, session, lo, hi) -> int:
+        """Process the rows in the key range, see `key_range()`, and return
+        the number of rows processed. Must not commit, the caller commits the
+        work together with the chunk checkpoint.
+        """
+        raise NotImplementedError
+
+    def key_range(self, lo, hi):
+        """The where clause for keys from lo (inclusive) to hi (exclusive),
+        hi is None for the last chunk.
+        """
+        if hi is None:
+            return self.key_column >= lo
+        return and_(self.key_column >= lo, self.key_column < hi)
+
+    def plan_chunks(self, session):
+        """Returns (lo, hi) key ranges of `chunk_size` rows each.
+
+        Every chunk_size-th key is picked as a boundary in one pass over the
+        key index, this works for any sortable key, including uuid strings.
+        """
+        row_no = func.row_number().over(order_by=self.key_column).label("row_no")
+        keys = select(self.key_column.label("key"), row_no).subquery()
+        bounds = session.scalars(
+            select(keys.c.key)
+            .where((keys.c.row_no - 1) % self.chunk_size == 0)
+            .order_by(keys.c.key)
+        ).all()
+        return list(zip(bounds, bounds[1:] + [None]))
+
+
+# job name -> job instance
+JOBS = {}
+
+
+def register_job(cls):
+    JOBS[cls.name] = cls()
+    return cls
+
+
+@register_job
+class BackfillTodoComplete(ChunkedJob):
+    """Set `complete` to false on todos where it was never set."""
+
+    name = "backfill_todo_complete"
+    key_column = Todo.__table__.c.id
+
+    def process_chunk(self, session, lo, hi):
+        result = session.execute(
+            update(Todo)
+            .where(self.key_range(lo, hi), Todo.complete.is_(None))
+            .values(complete=False, version=Todo.version + 1)
+            .execution_options(synchronize_session=False)
+        )
+        return result.rowcount
+
+
+def dispatch_chunks(job_id, chunk_nos):
+    """Fan out the chunks as a chord, with the summary as callback."""
+    return chord(run_chunk.s(job_id, chunk_no) for chunk_no in chunk_nos)(
+        finish_chunked_job.s(job_id, time.time())
+    )
+
+
+@shared_task(base=SqlAlchemyTask, bind=True, ignore_result=False)
+def start_chunked_job(self, job_name) -> str:
+    job = JOBS[job_name]
+    job_id = str(uuid.uuid4())
+    chunks = job.plan_chunks(db_session)
+    db_session.add_all(
+        JobChunk(job_id=job_id, chunk_no=no, job_name=job_name, lo=lo, hi=hi)
+        for no, (lo, hi) in enumerate(chunks)
+    )
+    db_session.commit()
+    LOG.info(f"job {job_name} [{job_id}] planned {len(chunks)} chunks")
+
+    if chunks:
+        dispatch_chunks(job_id, range(len(chunks)))
+    return job_id
+
+
+@shared_task(base=SqlAlchemyTask, bind=True, ignore_result=False)
+def resume_chunked_job(self, job_id) -> int:
+    chunk_nos = db_session.scalars(
+        select(JobChunk.chunk_no).where(
+            JobChunk.job_id == job_id, JobChunk.status != "done"
+        )
+    ).all()
+    db_session.commit()
+    LOG.info(f"job [{job_id}] resumed with {len(chunk_nos)} chunks left")
+
+    if chunk_nos:
+        dispatch_chunks(job_id, chunk_nos)
+    return len(chunk_nos)
+
+
+# acks_late so that a chunk whose worker died is delivered again
+@shared_task(base=SqlAlchemyTask, bind=True, ignore_result=False, acks_late=True)
+def run_chunk(self, job_id, chunk_no) -> int:
+    started = time.perf_counter()
+    try:
+        # lock the checkpoint row until commit, a redelivered copy of this
+        # task waits here and then sees the chunk done; populate_existing so
+        # that the status is the one read under the lock
+        chunk = db_session.get(
+            JobChunk,
+            (job_id, chunk_no),
+            with_for_update=True,
+            populate_existing=True,
+        )
+        if chunk.status == "done":
+            LOG.info(f"job [{job_id}] chunk {chunk_no} was already done")
+            return chunk.rows
+
+        rows = JOBS[chunk.job_name].process_chunk(db_session, chunk.lo, chunk.hi)
+        chunk.status = "done"
+        chunk.rows = rows
+        chunk.seconds = time.perf_counter() - started
+        db_session.commit()
+    except Exception:
+        db_session.rollback()
+        raise
+
+    LOG.info(
+        f"job {chunk.job_name} [{job_id}] chunk {chunk_no}: {rows} rows "
+        f"in {chunk.seconds:.3f}s, {rows / chunk.seconds:.1f} rows/s"
+    )
+    return rows
+
+
+@shared_task(base=SqlAlchemyTask, bind=True, ignore_result=False)
+def finish_chunked_job(self, results, job_id, dispatched_at) -> dict:
+    # results are the row counts of the chunks run in this dispatch
+    rows = sum(results)
+    elapsed = time.time() - dispatched_at
+    chunks, done, total_rows = db_session.execute(
+        select(
+            func.count(),
+            func.count().filter(JobChunk.status == "done"),
+            func.coalesce(func.sum(JobChunk.rows), 0),
+        ).where(JobChunk.job_id == job_id)
+    ).one()
+    db_session.commit()
+
+    summary = {
+        "job_id": job_id,
+        "chunks": chunks,
+        "done": done,
+        "rows": rows,
+        "total_rows": total_rows,
+        "seconds": round(elapsed, 3),
+        "rows_per_second": round(rows / elapsed, 1) if elapsed > 0 else None,
+    }
+    LOG.info(f"job [{job_id}] finished: {summary}")
+    return summary
@@ -1,9 +1,15 @@
-from datetime import datetime
+import logging
+import random
+import time
+from datetime import datetime, timedelta, timezone
 
 from celery import Task, shared_task
+from sqlalchemy import select
 from sqlalchemy.orm import scoped_session, sessionmaker
 
-from .model import Todo, db
+from .model import Todo, archive_todos, db
+
+LOG = logging.getLogger(__name__)
 
 # To call a task periodically you have to add an entry to the beat schedule list.
 # This requires beat scheduler worker process to be running, start it with:
@@ -18,6 +24,10 @@ CELERY_BEAT_SCHEDULE = {
         # "args": [{"complete": True}],
         "args": [{"complete": False}],
     },
+    "archive-completed-todos-hourly": {
+        "task": "mvc.celery_tasks.archive_completed_todos",
+        "schedule": 3600.0,
+    },
     # "test-every-3-seconds": {
     #     "task": "mvc.celery_tasks.test",
     #     "schedule": 3.0,  # every 3 seconds
@@ -49,6 +59,19 @@ db_session = scoped_session(
     sessionmaker(autocommit=False, autoflush=False, bind=engine)
 )
 
+# Read-only tasks use a separate session bound to a read replica, so that
+# table scans such as counting do not compete with writes on the primary.
+# Without a configured replica, it falls back to the primary engine.
+if Config.SQLALCHEMY_REPLICA_URIS:
+    read_engine = create_engine(
+        random.choice(Config.SQLALCHEMY_REPLICA_URIS), pool_recycle=3600, pool_size=5
+    )
+else:
+    read_engine = engine
+read_db_session = scoped_session(
+    sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
+)
+
 # This db engine is to be shared with all celery tasks that needs db session.
 # The recommended way is to create a abstract base class for celery tasks to
 # inherit.
@@ -85,6 +108,7 @@ class SqlAlchemyTask(Task):
     # this is called when task is returned
     def after_return(self, status, retval, task_id, args, kwargs, einfo):
         db_session.remove()
+        read_db_session.remove()
 
 
 # @shared_task is preferred over @task because @shared_task decorator is able
@@ -100,12 +124,71 @@ def count_todos(self, filters={}) -> int:
     # each celery task, but it should bind to the same db engine.
     # Session = sessionmaker(autocommit=False, autoflush=False, bind=db.engine)
     # session = Session()
-    todo_count = db_session.query(Todo).filter_by(**filters).count()
+    todo_count = read_db_session.query(Todo).filter_by(**filters).count()
     print(f"todos count (with filters {filters}): {todo_count}")
     # session.close()
     return todo_count
 
 
+# Completed todos are moved out of the hot `todos` table in small batches.
+# Each batch is its own short transaction: select a page of candidate ids, then
+# copy todos and assignments rows into the archive tables and delete them from
+# the hot tables. Short transactions keep row locks brief so that web requests
+# writing to the same tables are not blocked behind one huge archive run.
+# A todo only becomes complete through an update, so `updated_at` is used as
+# the completion time, compared directly so that each batch is a range scan of
+# the ix_todos_complete_updated_at index.
+
+
+@shared_task(base=SqlAlchemyTask, bind=True, ignore_result=False)
+def archive_completed_todos(self, days=None, batch_size=None) -> int:
+    if days is None:
+        days = Config.TODO_ARCHIVE_AFTER_DAYS
+    if batch_size is None:
+        batch_size = Config.TODO_ARCHIVE_BATCH_SIZE
+    cutoff = datetime.now(timezone.utc) - timedelta(days=days)
+
+    total = 0
+    started = time.perf_counter()
+    while True:
+        batch_start = time.perf_counter()
+        try:
+            # lock the candidate rows until the batch commits, so that a todo
+            # cannot be un-completed between this select and the move below
+            # rows locked by a web request writing them are skipped for now
+            todo_ids = db_session.scalars(
+                select(Todo.id)
+                .where(Todo.complete == True, Todo.updated_at < cutoff)
+                .order_by(Todo.updated_at)
+                .limit(batch_size)
+                .with_for_update(skip_locked=True)
+            ).all()
+            moved = archive_todos(db_session, todo_ids)
+            db_session.commit()
+        except Exception:
+            db_session.rollback()
+            raise
+        # time spent inside the batch transaction, i.e. how long row locks
+        # were held for this batch
+        lock_time = time.perf_counter() - batch_start
+        if not moved:
+            break
+        total += moved
+        LOG.info(
+            f"archived batch of {moved} todos, lock time {lock_time:.3f}s, "
+            f"{moved / lock_time:.1f} rows/s"
+        )
+        if moved < batch_size:
+            break
+
+    elapsed = time.perf_counter() - started
+    LOG.info(
+        f"archived {total} todos completed before {cutoff} in {elapsed:.3f}s, "
+        f"{total / elapsed if elapsed else 0:.1f} rows/s"
+    )
+    return total
+
+
 # A task with bind=True will have the task instance (self) passed as the first
 # argument to the task function, just like Python bound methods.
 # This is useful if you want to access meta-data related to the task execution.
@@ -0,0 +1,106 @@
+# events.py
+#
+# A small publish/subscribe bus for live todo change events.
+#
+# Write routes publish compact events (a dict, json serializable), and the
+# todos events endpoint streams them to browsers as server-sent events.
+# Two bus implementations are provided:
+# - InProcessEventBus: only reaches subscribers in the same worker process,
+#   good for the flask dev server or a single gunicorn worker
+# - RedisEventBus: redis pub/sub, reaches subscribers in every worker and
+#   every container, used when EVENT_BUS_URL is set
+#
+
+import json
+import logging
+import queue
+import threading
+
+from flask import Flask, current_app
+
+LOG = logging.getLogger(__name__)
+
+
+class InProcessEventBus:
+    def __init__(self, max_queue_size=1000):
+        self.max_queue_size = max_queue_size
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def publish(self, event):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for q in subscribers:
+            try:
+                q.put_nowait(event)
+            except queue.Full:
+                LOG.warning("event subscriber queue is full, event dropped")
+
+    def subscribe(self, timeout):
+        """Yield events as they are published, or None every `timeout` seconds
+        without an event, so that the caller can send a heartbeat.
+        """
+        q = queue.Queue(maxsize=self.max_queue_size)
+        with self._lock:
+            self._subscribers.add(q)
+        try:
+            while True:
+                try:
+                    yield q.get(timeout=timeout)
+                except queue.Empty:
+                    yield None
+        finally:
+            with self._lock:
+                self._subscribers.discard(q)
+
+
+class RedisEventBus:
+    def __init__(self, url, channel):
+        # import here so that redis is only needed when this bus is used
+        import redis
+
+        self.redis = redis.Redis.from_url(url)
+        self.channel = channel
+
+    def publish(self, event):
+        self.redis.publish(self.channel, json.dumps(event))
+
+    def subscribe(self, timeout):
+        """Yield events as they are published, or None every `timeout` seconds
+        without an event, so that the caller can send a heartbeat.
+        """
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self.channel)
+        try:
+            while True:
+                message = pubsub.get_message(timeout=timeout)
+                yield json.loads(message["data"]) if message else None
+        finally:
+            pubsub.close()
+
+
+def init_app(app: Flask):
+    url = app.config.get("EVENT_BUS_URL")
+    if url:
+        bus = RedisEventBus(url, app.config["EVENT_BUS_CHANNEL"])
+        app.logger.info(f"todo events use redis pub/sub bus: {url}")
+    else:
+        bus = InProcessEventBus()
+        app.logger.info(
+            "todo events use in-process bus, "
+            "live updates only reach viewers served by the same worker"
+        )
+    app.extensions["event_bus"] = bus
+
+
+def publish(event):
+    """Publish an event, a failing bus never fails the write that caused it."""
+    try:
+        current_app.extensions["event_bus"].publish(event)
+    except Exception as e:
+        LOG.error(f"failed to publish event: {event}")
+        LOG.error(e)
+
+
+def subscribe(timeout):
+    return current_app.extensions["event_bus"].subscribe(timeout)
@@ -65,6 +65,18 @@ def get_app_info():
     )
 
 
+@bp.route("/ratelimit", methods=["GET"])
+def get_ratelimit_stats():
+    """
+    Returns the rate limiter counters of admitted, limited (429) and shed
+    (503) requests by endpoint class.
+    """
+    limiter = current_app.extensions.get("ratelimit")
+    if limiter is None:
+        return dict(enabled=False)
+    return dict(enabled=True, pid=os.getpid(), **limiter.stats())
+
+
 def get_uptime():
     """
     Returns the number of seconds since the program started.
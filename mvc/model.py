@@ -1,16 +1,62 @@
 # model.py
 #
 
+import random
 import uuid
 
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import DateTime
+from flask_sqlalchemy.session import Session
+from sqlalchemy import (
+    DateTime,
+    Delete,
+    Insert,
+    Update,
+    delete,
+    exists,
+    insert,
+    literal,
+    select,
+)
 from sqlalchemy.orm import backref, validates
 from sqlalchemy.sql import func
 
+# bind keys in SQLALCHEMY_BINDS with this prefix are read replicas of the
+# primary SQLALCHEMY_DATABASE_URI database, see config.py
+REPLICA_BIND_PREFIX = "replica_"
+
+
+class RoutingSession(Session):
+    """A flask_sqlalchemy Session that sends reads to a read replica when the
+    session is marked with `session.info["read_replica"] = True`.
+    Flushes and INSERT/UPDATE/DELETE statements always go to the primary, and
+    the first write pins the rest of the session to the primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and self.info.get("read_replica") and not self._flushing:
+            if isinstance(clause, (Insert, Update, Delete)):
+                self.info["read_replica"] = False
+            else:
+                engine = self._replica_engine()
+                if engine is not None:
+                    return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    def _replica_engine(self):
+        # pick one replica per session so a request reads a consistent snapshot
+        if "replica_engine" not in self.info:
+            replicas = [
+                engine
+                for key, engine in self._db.engines.items()
+                if key and key.startswith(REPLICA_BIND_PREFIX)
+            ]
+            self.info["replica_engine"] = random.choice(replicas) if replicas else None
+        return self.info["replica_engine"]
+
+
 # flask_sqlalchemy's SQLAlchemy integrates flask with both sqlalchemy's 
 # core (Table) and orm (Model, which is based on declarative base).
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={"class_": RoutingSession})
 
 # for model relationships in sqlalchemy, see:
 # https://docs.sqlalchemy.org/en/20/orm/basic_relationships.html
@@ -39,6 +85,12 @@ class Todo(db.Model):
     # pass down to Table constructor args to set low-level settings such as 
     # schema name if needed
     # __table_args__ = {'schema': 'public'}
+    # completed todos are archived oldest first by completion time, see
+    # celery_tasks.archive_completed_todos, this index serves each batch
+    # without scanning and sorting the whole table
+    __table_args__ = (
+        db.Index("ix_todos_complete_updated_at", "complete", "updated_at"),
+    )
 
     # auto timestamping
     # use sqlalchemy's func.now() to ask DB to calculate the timestamp itself
@@ -54,6 +106,10 @@ class Todo(db.Model):
     title = db.Column(db.String(100))
     complete = db.Column(db.Boolean)
     pic = db.Column(db.LargeBinary, nullable=True)
+    # optimistic concurrency control, bumped on every update through
+    # todos.update and todos.patch, writers send back the version they have
+    # seen and get a 409 if it changed
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
 
     assignees = db.relationship(
         "User",
@@ -62,6 +118,9 @@ class Todo(db.Model):
         backref=db.backref("todos", lazy="subquery"),
     )
 
+    # let the orm unit of work check and bump the version as well
+    __mapper_args__ = {"version_id_col": version}
+
     def __repr__(self):
         return "<Todo {}>".format(self.title)
 
@@ -74,3 +133,170 @@ class User(db.Model):
 
     def __repr__(self):
         return "<User {}>".format(self.username)
+
+
+# archive tables for completed todos
+# completed todos are moved here by the `archive_completed_todos` celery task
+# so that the hot `todos` table (and its `assignments` rows) stays small.
+# the archive table mirrors the todos columns, plus an `archived_at` timestamp.
+
+archived_assignments = db.Table(
+    "archived_assignments",
+    db.Column(
+        "todo_id",
+        db.String(length=36),
+        db.ForeignKey("archived_todos.id"),
+        primary_key=True,
+    ),
+    # cascade so that deleting a user does not trip over archived rows
+    db.Column(
+        "user_id",
+        db.Integer,
+        db.ForeignKey("users.id", ondelete="CASCADE"),
+        primary_key=True,
+    ),
+)
+
+
+class ArchivedTodo(db.Model):
+    __tablename__ = "archived_todos"
+
+    created_at = db.Column(DateTime(timezone=True))
+    updated_at = db.Column(DateTime(timezone=True))
+    archived_at = db.Column(
+        DateTime(timezone=True), server_default=func.now(), index=True
+    )
+
+    id = db.Column("id", db.String(length=36), primary_key=True)
+    title = db.Column(db.String(100))
+    complete = db.Column(db.Boolean)
+    pic = db.Column(db.LargeBinary, nullable=True)
+    version = db.Column(db.Integer, nullable=False, server_default="1")
+
+    assignees = db.relationship("User", secondary=archived_assignments, lazy="select")
+
+    def __repr__(self):
+        return "<ArchivedTodo {}>".format(self.title)
+
+
+# progress checkpoints of chunked table-wide celery jobs, one row per chunk
+# see mvc/celery_jobs.py
+
+
+class JobChunk(db.Model):
+    __tablename__ = "job_chunks"
+
+    created_at = db.Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = db.Column(DateTime(timezone=True), onupdate=func.now())
+
+    job_id = db.Column(db.String(length=36), primary_key=True)
+    chunk_no = db.Column(db.Integer, primary_key=True)
+    job_name = db.Column(db.String(64), nullable=False)
+    # key range of the chunk, lo inclusive, hi exclusive, hi null for the last
+    # chunk, json so that both integer and string keys keep their type
+    lo = db.Column(db.JSON, nullable=False)
+    hi = db.Column(db.JSON(none_as_null=True), nullable=True)
+    # pending or done
+    status = db.Column(db.String(16), nullable=False, default="pending")
+    rows = db.Column(db.Integer, nullable=True)
+    seconds = db.Column(db.Float, nullable=True)
+
+    def __repr__(self):
+        return "<JobChunk {} #{} {}>".format(self.job_name, self.chunk_no, self.status)
+
+
+# columns copied between the hot and the archive table, in the same order
+_TODO_COLUMNS = [
+    "id",
+    "title",
+    "complete",
+    "pic",
+    "version",
+    "created_at",
+    "updated_at",
+]
+
+
+def _move_todos(session, todo_ids, src, dst, src_map, dst_map, overrides=None):
+    """Move todo rows and their assignment rows from one table pair to the
+    other with set-based INSERT ... SELECT and DELETE statements.
+    `overrides` maps column names to sql expressions replacing the copied value.
+    The caller owns the transaction, this function does not commit.
+    Returns the number of todo rows moved.
+    """
+    if not todo_ids:
+        return 0
+
+    overrides = overrides or {}
+    src_cols = [overrides.get(name, src.c[name]) for name in _TODO_COLUMNS]
+    session.execute(
+        insert(dst).from_select(
+            _TODO_COLUMNS, select(*src_cols).where(src.c.id.in_(todo_ids))
+        )
+    )
+    session.execute(
+        insert(dst_map).from_select(
+            ["todo_id", "user_id"],
+            select(src_map.c.todo_id, src_map.c.user_id).where(
+                src_map.c.todo_id.in_(todo_ids)
+            ),
+        )
+    )
+    session.execute(delete(src_map).where(src_map.c.todo_id.in_(todo_ids)))
+    result = session.execute(delete(src).where(src.c.id.in_(todo_ids)))
+    return result.rowcount
+
+
+def archive_todos(session, todo_ids):
+    """Move the given todos from `todos` into `archived_todos`."""
+    return _move_todos(
+        session,
+        todo_ids,
+        Todo.__table__,
+        ArchivedTodo.__table__,
+        assignments,
+        archived_assignments,
+    )
+
+
+def restore_todos(session, todo_ids):
+    """Move the given todos from `archived_todos` back into `todos`.
+    Restored todos count as just updated, so that the archive task does not
+    archive them again on its next run.
+    """
+    return _move_todos(
+        session,
+        todo_ids,
+        ArchivedTodo.__table__,
+        Todo.__table__,
+        archived_assignments,
+        assignments,
+        overrides={"updated_at": func.now()},
+    )
+
+
+def set_todo_assignees(session, todo_id, user_ids):
+    """Make the assignees of a todo exactly `user_ids`, by deleting and
+    inserting only the difference in `assignments`, without loading the todo
+    or the current assignees. Unknown user ids are ignored.
+    The caller owns the transaction, this function does not commit.
+    """
+    stmt = delete(assignments).where(assignments.c.todo_id == todo_id)
+    if user_ids:
+        stmt = stmt.where(assignments.c.user_id.not_in(user_ids))
+    session.execute(stmt)
+
+    if not user_ids:
+        return
+    already_assigned = exists().where(
+        assignments.c.todo_id == todo_id,
+        assignments.c.user_id == User.id,
+    )
+    session.execute(
+        insert(assignments).from_select(
+            ["todo_id", "user_id"],
+            select(literal(todo_id), User.id).where(
+                User.id.in_(user_ids), ~already_assigned
+            ),
+        )
+    )
@@ -0,0 +1,243 @@
+# ratelimit.py
+#
+# Admission control, to shed load before it reaches the db.
+#
+# Every request is put in an endpoint class, see `classify()`, and then:
+# - a token bucket per client ip and endpoint class limits the request rate,
+#   requests over the limit get a fast 429 Too Many Requests
+# - classes with a max in-flight count (the expensive ones, such as uploads
+#   and password hashing logins) get a fast 503 Service Unavailable when this
+#   worker is already busy with that many of them
+#
+# Token buckets live in process memory by default, or in redis when
+# RATELIMIT_STORAGE_URL is set, so that all workers and containers share the
+# same limits. In-flight limits are always per worker process, since they
+# protect the cpu and memory of the worker itself.
+#
+
+import logging
+import math
+import threading
+import time
+from collections import Counter
+
+from flask import Flask, g, make_response, request
+
+LOG = logging.getLogger(__name__)
+
+# requests that are never limited
+EXEMPT_ENDPOINTS = {"static", "home.health_check"}
+
+# non-safe requests to these endpoints get their own class, other requests
+# are "write" or "read" by method
+ENDPOINT_CLASSES = {
+    "todos.add": "upload",
+    "auth.login": "auth",
+    "auth.register": "auth",
+    "users.add": "auth",
+}
+
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+
+def classify():
+    """Returns the endpoint class of the current request, or None if exempt."""
+    if request.endpoint is None or request.endpoint in EXEMPT_ENDPOINTS:
+        return None
+    if request.method in SAFE_METHODS:
+        return "read"
+    return ENDPOINT_CLASSES.get(request.endpoint, "write")
+
+
+class MemoryStorage:
+    """Token buckets and counters in the memory of this process."""
+
+    # idle buckets are refilled and can be dropped, check every this many takes
+    PRUNE_EVERY = 10000
+
+    def __init__(self):
+        self._buckets = {}
+        self._counters = Counter()
+        self._lock = threading.Lock()
+        self._takes = 0
+
+    def take(self, key, rate, burst):
+        """Take a token from the bucket, returns 0 if taken, or else the
+        seconds until a token is available.
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - last) * rate)
+            retry_after = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                retry_after = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now)
+
+            self._takes += 1
+            if self._takes % self.PRUNE_EVERY == 0:
+                self._prune(now)
+        return retry_after
+
+    def _prune(self, now):
+        # a bucket idle for more than a minute is full again, same as missing
+        self._buckets = {
+            key: (tokens, last)
+            for key, (tokens, last) in self._buckets.items()
+            if now - last < 60
+        }
+
+    def incr(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def counters(self):
+        with self._lock:
+            return dict(self._counters)
+
+
+class RedisStorage:
+    """Token buckets and counters in redis, shared by all workers."""
+
+    # refill and take in one atomic step, using the redis clock so that all
+    # workers agree on the time
+    TAKE_SCRIPT = """
+    local rate = tonumber(ARGV[1])
+    local burst = tonumber(ARGV[2])
+    local t = redis.call('TIME')
+    local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+    local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+    local tokens = tonumber(state[1]) or burst
+    local ts = tonumber(state[2]) or now
+    tokens = math.min(burst, tokens + (now - ts) * rate)
+    local retry_after = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+    else
+        retry_after = (1 - tokens) / rate
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+    redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+    return tostring(retry_after)
+    """
+
+    def __init__(self, url, prefix):
+        # import here so that redis is only needed when this storage is used
+        import redis
+
+        self.redis = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self._take = self.redis.register_script(self.TAKE_SCRIPT)
+
+    def take(self, key, rate, burst):
+        return float(self._take(keys=[f"{self.prefix}:{key}"], args=[rate, burst]))
+
+    def incr(self, name):
+        self.redis.hincrby(f"{self.prefix}:counters", name, 1)
+
+    def counters(self):
+        return {
+            k.decode(): int(v)
+            for k, v in self.redis.hgetall(f"{self.prefix}:counters").items()
+        }
+
+
+class RateLimiter:
+    def __init__(self, storage, rules, max_in_flight):
+        self.storage = storage
+        # endpoint class -> (tokens per second, burst)
+        self.rules = rules
+        # endpoint class -> semaphore bounding concurrent requests
+        self.max_in_flight = max_in_flight
+        self.in_flight = {
+            name: threading.BoundedSemaphore(limit)
+            for name, limit in max_in_flight.items()
+        }
+
+    def admit(self):
+        """Returns a 429 or 503 response to shed the current request, or None
+        to let it through.
+        """
+        endpoint_class = classify()
+        if endpoint_class is None:
+            return None
+
+        rule = self.rules.get(endpoint_class)
+        if rule:
+            rate, burst = rule
+            try:
+                retry_after = self.storage.take(
+                    f"{endpoint_class}:{g.client_ip}", rate, burst
+                )
+            except Exception as e:
+                # fail open, a broken limiter must not take the app down
+                LOG.error("rate limiter storage failed, request let through")
+                LOG.error(e)
+                retry_after = 0
+            if retry_after:
+                self._count(f"{endpoint_class}.limited")
+                LOG.info(f"rate limited {endpoint_class} request from {g.client_ip}")
+                return self._reject(429, "Too Many Requests", retry_after)
+
+        semaphore = self.in_flight.get(endpoint_class)
+        if semaphore:
+            if not semaphore.acquire(blocking=False):
+                self._count(f"{endpoint_class}.shed")
+                LOG.info(f"shed {endpoint_class} request, too many in flight")
+                return self._reject(503, "Service Unavailable", 1)
+            g.ratelimit_semaphore = semaphore
+
+        self._count(f"{endpoint_class}.admitted")
+        return None
+
+    def release(self):
+        semaphore = g.pop("ratelimit_semaphore", None)
+        if semaphore:
+            semaphore.release()
+
+    def stats(self):
+        return {
+            "counters": self.storage.counters(),
+            "rules": self.rules,
+            "max_in_flight": self.max_in_flight,
+        }
+
+    def _count(self, name):
+        try:
+            self.storage.incr(name)
+        except Exception as e:
+            LOG.error(e)
+
+    def _reject(self, status, message, retry_after):
+        resp = make_response(message, status)
+        resp.headers["Retry-After"] = str(math.ceil(retry_after))
+        return resp
+
+
+def init_app(app: Flask):
+    if not app.config["RATELIMIT_ENABLED"]:
+        app.logger.info("rate limiting is disabled")
+        return
+
+    url = app.config.get("RATELIMIT_STORAGE_URL")
+    if url:
+        storage = RedisStorage(url, app.config["RATELIMIT_KEY_PREFIX"])
+        app.logger.info(f"rate limiter uses redis storage: {url}")
+    else:
+        storage = MemoryStorage()
+        app.logger.info("rate limiter uses per-process memory storage")
+
+    limiter = RateLimiter(
+        storage, app.config["RATELIMIT_RULES"], app.config["RATELIMIT_MAX_IN_FLIGHT"]
+    )
+    app.extensions["ratelimit"] = limiter
+
+    # needs g.client_ip, and must come before interceptors that query the db
+    app.before_request(limiter.admit)
+
+    # also called after a streamed response is fully sent
+    @app.teardown_request
+    def release_in_flight(error=None):
+        limiter.release()
@@ -0,0 +1,82 @@
+# replicas.py
+#
+# Read replica routing for web requests.
+#
+# The RoutingSession in model.py sends reads to a replica bind when the
+# session is marked `read_replica`. This module decides per request whether
+# to mark it:
+# - safe methods (GET, HEAD, OPTIONS) read from a replica
+# - any other method reads and writes on the primary
+# - after a client sends a write request, its reads stay on the primary for
+#   DB_REPLICA_STICKY_SECONDS (read-your-writes), tracked in the flask session
+#
+
+import sqlite3
+import time
+
+import click
+from flask import Flask, request, session
+from flask.cli import with_appcontext
+
+from mvc.model import REPLICA_BIND_PREFIX, db
+
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+
+def init_app(app: Flask):
+    if not app.config.get("SQLALCHEMY_REPLICA_URIS"):
+        app.logger.info("no read replica configured, all queries use primary")
+        return
+
+    app.logger.info(
+        f"read replica routing enabled with "
+        f"{len(app.config['SQLALCHEMY_REPLICA_URIS'])} replica(s)"
+    )
+    sticky_seconds = app.config["DB_REPLICA_STICKY_SECONDS"]
+
+    # this has to be registered before any before_request that queries db
+    @app.before_request
+    def route_db_session():
+        if request.method not in SAFE_METHODS:
+            return
+        last_write = session.get("db_last_write_at", 0)
+        if time.time() - last_write < sticky_seconds:
+            app.logger.debug("recent write by client, reading from primary")
+            return
+        db.session.info["read_replica"] = True
+
+    @app.after_request
+    def mark_client_write(response):
+        if request.method not in SAFE_METHODS:
+            session["db_last_write_at"] = time.time()
+        return response
+
+    app.cli.add_command(sync_replicas)
+
+
+@click.command("sync-replicas")
+@with_appcontext
+def sync_replicas():
+    """Copy the primary sqlite db file into the sqlite replica files.
+
+    This is for local testing only, where sqlite files stand in for a primary
+    and its replicas. Real replicas are kept in sync by the database itself.
+    """
+    primary = db.engines[None]
+    if primary.url.get_backend_name() != "sqlite":
+        raise click.ClickException("sync-replicas only supports sqlite")
+
+    src = sqlite3.connect(primary.url.database)
+    for key, engine in db.engines.items():
+        if not key or not key.startswith(REPLICA_BIND_PREFIX):
+            continue
+        if engine.url.get_backend_name() != "sqlite":
+            raise click.ClickException(f"replica {key} is not a sqlite db")
+        # release pooled connections before the file is overwritten
+        engine.dispose()
+        dst = sqlite3.connect(engine.url.database)
+        with dst:
+            src.backup(dst)
+        dst.close()
+        click.echo(f"synced {primary.url.database} -> {engine.url.database}")
+    src.close()
@@ -0,0 +1,191 @@
+// todos.js
+//
+// Assignee search and live updates for the todos page.
+// - assignee pickers only list the current assignees, other users are
+//   searched by username prefix and added to the picker
+// - todo forms are submitted with fetch(), so the page is not reloaded
+// - changes made by anyone, including this page, arrive as server-sent
+//   events and are patched into the list in place
+
+(function () {
+  let searchTimer = null;
+  document.addEventListener("input", (e) => {
+    const input = e.target;
+    if (!input.classList.contains("assignee-search")) {
+      return;
+    }
+    clearTimeout(searchTimer);
+    searchTimer = setTimeout(() => searchUsers(input), 200);
+  });
+
+  async function searchUsers(input) {
+    const select = input.parentElement.querySelector("select[name=assignee_ids]");
+    // drop the unselected results of the previous search
+    select.querySelectorAll("option:not(:checked)").forEach((o) => o.remove());
+    const q = input.value.trim();
+    if (!q) {
+      return;
+    }
+    const resp = await fetch(input.dataset.searchUrl + "?q=" + encodeURIComponent(q));
+    if (!resp.ok) {
+      return;
+    }
+    for (const user of await resp.json()) {
+      if (!select.querySelector(`option[value="${user.id}"]`)) {
+        select.add(new Option(user.username, user.id));
+      }
+    }
+  }
+})();
+
+(function () {
+  const list = document.getElementById("todo-list");
+  if (!list || !window.EventSource) {
+    return;
+  }
+
+  document.addEventListener("submit", async (e) => {
+    const form = e.target;
+    if (!form.dataset.live) {
+      return;
+    }
+    e.preventDefault();
+    const resp = await fetch(form.action, {
+      method: "POST",
+      body: new FormData(form),
+      headers: { Accept: "application/json" },
+    });
+    if (resp.status === 409) {
+      alert("This todo was changed by someone else, the page will reload.");
+      window.location.reload();
+      return;
+    } else if (!resp.ok) {
+      window.location.reload();
+      return;
+    }
+    // apply the change from the response right away, the event for it may
+    // be published on another worker and never reach this page
+    if (form.dataset.live === "delete") {
+      form.closest("[id^=todo-]").remove();
+      return;
+    }
+    const event = await resp.json();
+    if (form.dataset.live === "add") {
+      form.reset();
+    }
+    handlers[event.type](event);
+  });
+
+  // ticking a todo or changing its title is saved right away as a single
+  // field edit, checked against the version like an update, the update
+  // button is still needed for assignee changes
+  document.addEventListener("change", async (e) => {
+    const input = e.target;
+    const form = input.form;
+    if (!form || !form.dataset.patchUrl) {
+      return;
+    }
+    const body = new FormData();
+    body.append("version", form.elements.version.value);
+    if (input.name === "complete") {
+      body.append("complete", input.checked ? "true" : "false");
+    } else if (input.name === "title") {
+      body.append("title", input.value);
+    } else {
+      return;
+    }
+    const resp = await fetch(form.dataset.patchUrl, {
+      method: "POST",
+      body: body,
+      headers: { Accept: "application/json" },
+    });
+    if (resp.status === 409) {
+      alert("This todo was changed by someone else, the page will reload.");
+      window.location.reload();
+      return;
+    } else if (!resp.ok) {
+      window.location.reload();
+      return;
+    }
+    // the next edit or update of this todo must send the new version
+    updated(await resp.json());
+  });
+
+  function setVersion(item, version) {
+    // the response and the event of the same write can arrive in any order,
+    // never go back to an older version
+    item.querySelectorAll("input[name=version]").forEach((input) => {
+      input.value = Math.max(Number(input.value), version);
+    });
+  }
+
+  async function fetchFragment(id) {
+    const resp = await fetch(list.dataset.fragmentUrl.replace("__id__", id));
+    return resp.ok ? resp.text() : null;
+  }
+
+  async function added(event) {
+    if (document.getElementById("todo-" + event.id)) {
+      return;
+    }
+    const html = await fetchFragment(event.id);
+    // the response and the event of the same add may both have fetched it
+    if (html && !document.getElementById("todo-" + event.id)) {
+      list.insertAdjacentHTML("afterbegin", html);
+    }
+  }
+
+  async function updated(event) {
+    const item = document.getElementById("todo-" + event.id);
+    if (!item) {
+      return;
+    }
+    // a new assignee is not in the picker yet, re-render this todo
+    const picker = item.querySelector("select[name=assignee_ids]");
+    const known = Array.from(picker.options, (o) => Number(o.value));
+    if (event.assignee_ids && event.assignee_ids.some((id) => !known.includes(id))) {
+      const html = await fetchFragment(event.id);
+      if (html) {
+        item.outerHTML = html;
+      }
+      return;
+    }
+    // single field edits only carry the fields that changed
+    if ("title" in event) {
+      item.querySelector(".todo-title").textContent = event.title;
+      item.querySelector("input[name=title]").value = event.title;
+    }
+    if ("complete" in event) {
+      const status = item.querySelector(".todo-status");
+      status.textContent = event.complete ? "Completed" : "Not Complete";
+      status.classList.toggle("green", event.complete);
+      status.classList.toggle("gray", !event.complete);
+      item.querySelector("input[name=complete]").checked = event.complete;
+    }
+    if (event.assignee_ids) {
+      picker.querySelectorAll("option").forEach((o) => {
+        o.selected = event.assignee_ids.includes(Number(o.value));
+      });
+    }
+    if ("version" in event) {
+      setVersion(item, event.version);
+    }
+  }
+
+  function deleted(event) {
+    const item = document.getElementById("todo-" + event.id);
+    if (item) {
+      item.remove();
+    }
+  }
+
+  const handlers = { added: added, updated: updated, deleted: deleted };
+  const source = new EventSource(list.dataset.eventsUrl);
+  source.addEventListener("todo", (e) => {
+    const event = JSON.parse(e.data);
+    const handler = handlers[event.type];
+    if (handler) {
+      handler(event);
+    }
+  });
+})();
@@ -1,3 +1,4 @@
+import json
 import logging
 import os
 from base64 import b64encode
@@ -6,17 +7,23 @@ from threading import currentThread
 from flask import (
     Blueprint,
     Flask,
+    abort,
     current_app,
     flash,
+    get_flashed_messages,
+    jsonify,
     redirect,
     render_template,
     request,
+    stream_template,
     url_for,
 )
 from sqlalchemy import desc
+from sqlalchemy.orm import lazyload, load_only, selectinload
 from werkzeug.utils import secure_filename
 
-from mvc.model import Todo, User, db
+from mvc import events
+from mvc.model import Todo, User, assignments, db, set_todo_assignees
 
 LOG = logging.getLogger(__name__)
 
@@ -24,41 +31,122 @@ LOG = logging.getLogger(__name__)
 bp = Blueprint("todos", __name__)
 
 
-@bp.route("/todos", methods=["GET"])
-def home():
-    rs = Todo.query.order_by(desc(Todo.created_at)).all()
-    # rs = Todo.query.all()
-    todo_list = []
-    for todo in rs:
+# number of todos fetched from the db cursor at a time while streaming the
+# todos page, this bounds how many todos (and image blobs) are held in memory
+TODO_STREAM_CHUNK_SIZE = 50
+
+
+def iter_todo_list(todo_id=None):
+    """Yield todos as template dicts, newest first, fetching them from the db
+    in chunks of TODO_STREAM_CHUNK_SIZE rows.
+    Pass `todo_id` to only yield that one todo.
+    """
+    stmt = (
+        db.select(Todo)
+        .options(
+            # subquery eager loading does not work with yield_per, selectin
+            # loads the assignees of each chunk with one extra query
+            # only id and username of assignees are needed, and lazyload
+            # stops the users' own todos backref from being loaded
+            selectinload(Todo.assignees).options(
+                load_only(User.id, User.username), lazyload(User.todos)
+            ),
+        )
+        .order_by(desc(Todo.created_at))
+        # yield_per uses a server-side cursor where the db driver supports it
+        .execution_options(yield_per=TODO_STREAM_CHUNK_SIZE)
+    )
+    if todo_id is not None:
+        stmt = stmt.where(Todo.id == todo_id)
+    # edits that were acknowledged but not flushed to the db yet
+    write_behind = current_app.extensions.get("todo_write_behind")
+    pending = write_behind.pending() if write_behind else {}
+    for todo in db.session.scalars(stmt):
         t = {
             "id": todo.id,
             "title": todo.title,
             "complete": todo.complete,
+            "version": todo.version,
             "assignees": todo.assignees,
+            "assignee_ids": {user.id for user in todo.assignees},
         }
+        t.update(pending.get(todo.id, {}))
 
+        # transform blob to base64 for img tag data:uri
         try:
             if todo.pic:
                 t["img"] = b64encode(todo.pic).decode("utf-8")
         except Exception as e:
             current_app.logger.error("error transcoding image", e)
 
-        todo_list.append(t)
+        yield t
+
+
+def wants_json():
+    """Whether the client is the todos page script, which submits forms with
+    fetch() and asks for json instead of a redirect to the whole page.
+    """
+    return request.accept_mimetypes.best == "application/json"
+
+
+@bp.route("/todos", methods=["GET"])
+def home():
+    # the assignee pickers only list current assignees, other users are
+    # looked up with the users.search endpoint, so the page does not load
+    # every user
+
+    # stream the page while todos are fetched, so the first bytes go out
+    # right away and memory is bounded by the fetch chunk size instead of
+    # the number of todos
+    # stream_template keeps the request context (and db session) open
+    # until the whole page is sent, but the session cookie is saved before
+    # the body is rendered, so flashed messages are popped here, while the
+    # session can still be saved without them
+    return stream_template(
+        "todos/home.html",
+        todo_list=iter_todo_list(),
+        flashed_messages=get_flashed_messages(),
+    )
+
 
-    # transform blob to base64 for img tag data:uri
-    # todo_list = [
-    #     {
-    #         'id': todo.id,
-    #         'title': todo.title,
-    #         'complete': todo.complete,
-    #         'img': b64encode(todo.pic).decode("utf-8")
-    #     } for todo in Todo.query.all()
-    # ]
+@bp.route("/todos/<todo_id>/fragment", methods=["GET"])
+def fragment(todo_id):
+    # the html of a single todo, used by the page script to show new todos
+    # it is fetched right after the todo was written, read it from the primary
+    # as a read replica may not have the new row yet
+    db.session.info["read_replica"] = False
+    todo = next(iter_todo_list(todo_id), None)
+    if todo is None:
+        abort(404)
+    return render_template("todos/_todo.html", todo=todo)
 
-    # get all users as candidate assignees
-    user_list = User.query.all()
 
-    return render_template("todos/home.html", todo_list=todo_list, user_list=user_list)
+@bp.route("/todos/events", methods=["GET"])
+def event_stream():
+    heartbeat = current_app.config["EVENT_STREAM_HEARTBEAT_SECONDS"]
+    subscription = events.subscribe(heartbeat)
+    # the stream stays open for as long as the page is open, give the db
+    # connection used by the request interceptors back to the pool now
+    db.session.close()
+
+    # server-sent events, see:
+    # https://html.spec.whatwg.org/multipage/server-sent-events.html
+    def stream():
+        # tell the browser how soon to reconnect if the stream drops
+        yield "retry: 3000\n\n"
+        for event in subscription:
+            if event is None:
+                # comment line, keeps proxies from closing an idle stream and
+                # lets the server notice a client that went away
+                yield ": keep-alive\n\n"
+            else:
+                yield f"event: todo\ndata: {json.dumps(event)}\n\n"
+
+    return current_app.response_class(
+        stream(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 @bp.route("/todos/add", methods=["POST"])
@@ -105,7 +193,8 @@ def add():
     new_todo.assignees = assignees
 
     if file_err:
-        flash(file_err)
+        if not wants_json():
+            flash(file_err)
         LOG.warn(file_err)
         new_todo.pic = None
     else:
@@ -117,37 +206,180 @@ def add():
         new_todo.pic = blob
 
     db.session.add(new_todo)
+    # flush to get the generated id and version, and build the event before
+    # the commit expires the todo, which would reload it with its pic blob
+    db.session.flush()
+    event = {
+        "type": "added",
+        "id": new_todo.id,
+        "title": new_todo.title,
+        "complete": new_todo.complete,
+        "version": new_todo.version,
+    }
     db.session.commit()
+    events.publish(event)
+    if wants_json():
+        return jsonify({**event, "message": file_err}), 201
     return redirect(url_for("todos.home"))
 
 
 @bp.route("/todos/update/<todo_id>", methods=["POST", "PUT"])
 def update(todo_id):
+    new_title = request.form.get("title")
+    new_complete = bool(request.form.get("complete"))
+    new_assignee_ids = request.form.getlist("assignee_ids", type=int)
+    # the version the client has seen, optional for older clients
+    version, pending = take_pending_edits(
+        todo_id, request.form.get("version", type=int)
+    )
+
+    # update the row in place with a single UPDATE statement, so the todo
+    # (and its pic blob) is never loaded
+    # the version check makes it a compare-and-set against concurrent writers
+    stmt = db.update(Todo).where(Todo.id == todo_id)
+    if version is not None:
+        stmt = stmt.where(Todo.version == version)
+    stmt = (
+        stmt.values(title=new_title, complete=new_complete, version=Todo.version + 1)
+        .returning(Todo.version)
+        .execution_options(synchronize_session=False)
+    )
+
     try:
-        todo = Todo.query.filter_by(id=todo_id).first()
-        new_title = request.form.get("title")
-        new_complete = bool(request.form.get("complete"))
-        new_assignee_ids = request.form.getlist("assignee_ids")
-        new_assignees = User.query.filter(User.id.in_(new_assignee_ids)).all()
-
-        if todo:
-            todo.title = new_title
-            todo.complete = new_complete
-            todo.assignees = new_assignees
-            db.session.commit()
-        current_app.logger.debug(f">> todo [{todo.id}] was updated")
-        flash(f"a todo [{todo.id}] was updated")
+        new_version = db.session.execute(stmt).scalar_one_or_none()
+        if new_version is not None:
+            set_todo_assignees(db.session, todo_id, new_assignee_ids)
+        db.session.commit()
     except Exception as e:
-        LOG.error(f"Failed to update todo: {todo}")
+        db.session.rollback()
+        restore_pending_edits(todo_id, pending)
+        LOG.error(f"Failed to update todo: {todo_id}")
         LOG.error(e)
+        if wants_json():
+            abort(500)
+        flash(f"failed to update todo [{todo_id}]")
+        return redirect(url_for("todos.home"))
+
+    if new_version is None:
+        restore_pending_edits(todo_id, pending)
+        if version is not None:
+            abort(409, f"todo [{todo_id}] was changed or deleted by someone else")
+        if wants_json():
+            abort(404)
+        flash(f"no todo [{todo_id}] found")
+        return redirect(url_for("todos.home"))
+
+    current_app.logger.debug(f">> todo [{todo_id}] was updated")
+    event = {
+        "type": "updated",
+        "id": todo_id,
+        "title": new_title,
+        "complete": new_complete,
+        "version": new_version,
+        "assignee_ids": new_assignee_ids,
+    }
+    events.publish(event)
+    if wants_json():
+        return jsonify(event)
+    flash(f"a todo [{todo_id}] was updated")
+    return redirect(url_for("todos.home"))
+
+
+@bp.route("/todos/patch/<todo_id>", methods=["POST", "PATCH"])
+def patch(todo_id):
+    # single field edits, sent by the page script when a todo is ticked or its
+    # title is changed, version checked and bumped like todos.update
+    version = request.form.get("version", type=int)
+    if version is None:
+        return jsonify(error="version is required"), 400
+    fields = {}
+    if "title" in request.form:
+        fields["title"] = request.form["title"]
+        # rejected here rather than by the db, where a buffered edit would
+        # only fail at the flush
+        if len(fields["title"]) > Todo.title.type.length:
+            return jsonify(error="title is too long"), 400
+    if "complete" in request.form:
+        fields["complete"] = request.form["complete"] == "true"
+    if not fields:
+        return jsonify(error="nothing to update"), 400
+
+    write_behind = current_app.extensions.get("todo_write_behind")
+    if write_behind:
+        # acknowledged now, written to the db and published by the next flush
+        new_version = write_behind.put(todo_id, fields, version)
+        if new_version is None:
+            abort(409, f"todo [{todo_id}] was changed by someone else")
+        event = {"type": "updated", "id": todo_id, **fields, "version": new_version}
+        status = 202
+    else:
+        new_version = db.session.execute(
+            db.update(Todo)
+            .where(Todo.id == todo_id, Todo.version == version)
+            .values(**fields, version=Todo.version + 1)
+            .returning(Todo.version)
+            .execution_options(synchronize_session=False)
+        ).scalar_one_or_none()
+        db.session.commit()
+        if new_version is None:
+            abort(409, f"todo [{todo_id}] was changed or deleted by someone else")
+        event = {"type": "updated", "id": todo_id, **fields, "version": new_version}
+        events.publish(event)
+        status = 200
+
+    if wants_json():
+        return jsonify(event), status
     return redirect(url_for("todos.home"))
 
 
+def take_pending_edits(todo_id, version):
+    """Take the buffered edits of a todo that is updated or deleted, returns
+    the version to check against and the edits, to put back with
+    `restore_pending_edits()` if the update or delete fails.
+    """
+    write_behind = current_app.extensions.get("todo_write_behind")
+    pending = write_behind.discard(todo_id) if write_behind else None
+    # a client that has seen the buffered edits sends the version the todo
+    # would have after their flush, which is not in the db yet
+    if pending and version == pending["version"] + 1:
+        return pending["version"], pending
+    return version, pending
+
+
+def restore_pending_edits(todo_id, pending):
+    if pending:
+        current_app.extensions["todo_write_behind"].restore(todo_id, pending)
+
+
 # @bp.route('/todos/delete/<int:todo_id>')
 @bp.route("/todos/delete/<todo_id>", methods=["POST", "DELETE"])
 def delete(todo_id):
-    todo = Todo.query.filter_by(id=todo_id).first()
-    db.session.delete(todo)
+    version, pending = take_pending_edits(
+        todo_id, request.form.get("version", type=int)
+    )
+
+    # delete the assignment rows and the todo row directly, without loading
+    # the todo first
+    stmt = db.delete(Todo).where(Todo.id == todo_id)
+    if version is not None:
+        stmt = stmt.where(Todo.version == version)
+    db.session.execute(db.delete(assignments).where(assignments.c.todo_id == todo_id))
+    result = db.session.execute(stmt.execution_options(synchronize_session=False))
+    if not result.rowcount:
+        # also brings back the assignments deleted above
+        db.session.rollback()
+        restore_pending_edits(todo_id, pending)
+        if version is not None:
+            abort(409, f"todo [{todo_id}] was changed or deleted by someone else")
+        if wants_json():
+            abort(404)
+        flash(f"no todo [{todo_id}] found")
+        return redirect(url_for("todos.home"))
+
     db.session.commit()
+
+    events.publish({"type": "deleted", "id": todo_id})
+    if wants_json():
+        return "", 204
     flash("a todo was deleted")
     return redirect(url_for("todos.home"))
@@ -1,5 +1,6 @@
 import logging
 import os
+import sys
 from base64 import b64encode
 from threading import currentThread
 
@@ -8,16 +9,19 @@ from flask import (
     Flask,
     current_app,
     flash,
+    jsonify,
     redirect,
     render_template,
     request,
     url_for,
 )
+from sqlalchemy import desc
+from sqlalchemy.orm import lazyload, load_only, selectinload
 from werkzeug.security import check_password_hash, generate_password_hash
 from werkzeug.utils import secure_filename
 
 from mvc.auth import login_required
-from mvc.model import Todo, User, db
+from mvc.model import Todo, User, archived_assignments, assignments, db
 
 LOG = logging.getLogger(__name__)
 
@@ -25,22 +29,70 @@ LOG = logging.getLogger(__name__)
 bp = Blueprint("users", __name__)
 
 
+USERS_PAGE_SIZE = 50
+USERS_SEARCH_LIMIT = 20
+
+
 @bp.route("/users", methods=["GET"])
 def index():
-    rs = User.query.all()
-    user_list = [user for user in rs]
-    # for user in rs:
-    # t = {
-    #     'id': user.id,
-    #     'username': user.username
-    # }
-    # user_list.append(t)
+    # keyset pagination by username: a page is the next (or previous) page
+    # size of usernames after (or before) a given one, which is a range scan
+    # on the username index, no matter how many users there are
+    after = request.args.get("after")
+    before = request.args.get("before")
+
+    stmt = db.select(User).options(
+        # only the titles of the listed users' todos, without their image
+        # blobs and without eager loading each todo's assignees in turn
+        selectinload(User.todos).options(
+            load_only(Todo.id, Todo.title), lazyload(Todo.assignees)
+        )
+    )
+    if before is not None:
+        stmt = stmt.where(User.username < before).order_by(desc(User.username))
+    else:
+        if after is not None:
+            stmt = stmt.where(User.username > after)
+        stmt = stmt.order_by(User.username)
+    # fetch one extra row to know if there is more in that direction
+    user_list = db.session.scalars(stmt.limit(USERS_PAGE_SIZE + 1)).all()
+    has_more = len(user_list) > USERS_PAGE_SIZE
+    user_list = user_list[:USERS_PAGE_SIZE]
+
+    if before is not None:
+        user_list.reverse()
+        has_prev, has_next = has_more, True
+    else:
+        has_prev, has_next = after is not None, has_more
 
     return render_template(
-        "users/index.html", user_list=user_list, title="Todo App - Users"
+        "users/index.html",
+        user_list=user_list,
+        has_prev=has_prev,
+        has_next=has_next,
+        title="Todo App - Users",
     )
 
 
+@bp.route("/users/search", methods=["GET"])
+def search():
+    """Returns id and username of users whose username starts with `q`."""
+    prefix = request.args.get("q", "")
+    limit = max(1, min(request.args.get("limit", USERS_SEARCH_LIMIT, type=int), 100))
+
+    stmt = db.select(User.id, User.username)
+    if prefix:
+        # a range condition rather than LIKE 'prefix%', so that the
+        # ix_users_username index is used regardless of the db's LIKE rules
+        stmt = stmt.where(User.username >= prefix)
+        last = ord(prefix[-1])
+        if last < sys.maxunicode:
+            stmt = stmt.where(User.username < prefix[:-1] + chr(last + 1))
+    rows = db.session.execute(stmt.order_by(User.username).limit(limit))
+
+    return jsonify([{"id": row.id, "username": row.username} for row in rows])
+
+
 @bp.route("/users/add", methods=["POST"])
 def add():
     username = request.form.get("username")
@@ -89,8 +141,20 @@ def update(user_id):
 
 @bp.route("/users/delete/<user_id>", methods=["POST", "DELETE"])
 def delete(user_id):
-    user = User.query.filter_by(id=user_id).first()
-    db.session.delete(user)
+    # delete the mapping rows and the user row directly, without loading the
+    # user, which would also load all its todos through the backref
+    db.session.execute(db.delete(assignments).where(assignments.c.user_id == user_id))
+    db.session.execute(
+        db.delete(archived_assignments).where(archived_assignments.c.user_id == user_id)
+    )
+    result = db.session.execute(
+        db.delete(User)
+        .where(User.id == user_id)
+        .execution_options(synchronize_session=False)
+    )
     db.session.commit()
-    flash(f"a user {user.id} was deleted")
+    if result.rowcount:
+        flash(f"a user {user_id} was deleted")
+    else:
+        flash(f"no user {user_id} found")
     return redirect(url_for("users.index"))
@@ -0,0 +1,489 @@
+# writebehind.py
+#
+# Optional write-behind buffer for high-frequency todo field edits, such as
+# ticking a todo complete and incomplete in quick succession.
+#
+# With TODO_WRITE_BEHIND enabled, `todos.patch` acknowledges an edit of the
+# `title` or `complete` field right away (202 Accepted) and only records it in
+# this buffer. Edits are coalesced per todo id, last writer wins per field, and
+# flushed to the db in one batched transaction every
+# TODO_WRITE_BEHIND_INTERVAL seconds, or sooner once
+# TODO_WRITE_BEHIND_MAX_PENDING todos are pending.
+#
+# Pending edits live in process memory by default, or in redis when
+# TODO_WRITE_BEHIND_URL is set. With several workers behind a load balancer,
+# redis is needed for the edits of a todo to be coalesced whatever worker
+# they reach; in memory, an edit of a todo with pending edits on another
+# worker gets a 409.
+#
+# Every edit carries the todo version the client has seen, like todos.update:
+# - the first edit of a todo is checked against the version in the db, or
+#   the version a flush in progress gives the todo, and gets a 409 if it is
+#   stale
+# - the flush writes the edits only if the todo still has that version, and
+#   bumps it by one
+# - the response has the version the todo will have after the flush, further
+#   edits of the same todo must send that version to be coalesced, any other
+#   version gets a 409
+# - an edit that still loses at the flush, because the todo was changed
+#   through todos.update in the meantime, is dropped and logged, and the
+#   current todo is published so that open pages show it again
+# - todos.update and todos.delete take the pending edits of their todo, and
+#   put them back if they fail
+#
+# Durability, which is weaker than for the other write routes:
+# - acknowledged edits are not in the db until they are flushed, a crash,
+#   SIGKILL or OOM kill of a worker loses at most the last interval of edits
+#   buffered in its memory, or being flushed by it from redis
+# - on graceful shutdown (gunicorn SIGTERM, ctrl-c of the dev server) the
+#   buffer is flushed by an atexit hook before the process exits
+# - a failed flush is retried one todo at a time, edits that fail on their
+#   own are dropped and logged, edits that fail because the db is unavailable
+#   are kept, under any newer edits, and retried at the next interval
+# - edits still pending at shutdown, e.g. with the db down, are lost from
+#   memory, or left in redis for the other workers
+# - edits of a todo deleted before the flush are dropped
+# - the todos page shows pending edits, of the same worker only when they
+#   are kept in memory
+#
+
+import atexit
+import json
+import logging
+import threading
+
+from flask import Flask
+from sqlalchemy import bindparam, select, update
+from sqlalchemy.exc import OperationalError
+
+from mvc import events
+from mvc.model import Todo, db
+
+LOG = logging.getLogger(__name__)
+
+# the only fields that can be written behind
+FIELDS = ("title", "complete")
+
+# results of put() other than the version the todo gets
+CONFLICT = -1
+MISSING = 0
+
+
+class MemoryStorage:
+    """Pending edits in the memory of this process.
+
+    An entry is {"version": version the edits are based on, "fields":
+    {field: value}}.
+    """
+
+    shared = False
+
+    def __init__(self):
+        # todo id -> entry
+        self._pending = {}
+        # todo id -> version of the entries being flushed
+        self._flushing = {}
+        self._lock = threading.Lock()
+
+    def put(self, todo_id, fields, version, create):
+        """Coalesce the edits into the entry of the todo, or create it if
+        `create`. Returns the version the todo gets, CONFLICT or MISSING, and
+        the number of todos pending.
+        """
+        with self._lock:
+            entry = self._pending.get(todo_id)
+            if entry is None:
+                if not create:
+                    return MISSING, len(self._pending)
+                entry = self._pending[todo_id] = {"version": version, "fields": {}}
+            elif version != entry["version"] + 1:
+                return CONFLICT, len(self._pending)
+            entry["fields"].update(fields)
+            return entry["version"] + 1, len(self._pending)
+
+    def pending(self):
+        with self._lock:
+            return {
+                todo_id: {"version": entry["version"], "fields": dict(entry["fields"])}
+                for todo_id, entry in self._pending.items()
+            }
+
+    def discard(self, todo_id):
+        with self._lock:
+            return self._pending.pop(todo_id, None)
+
+    def flushing(self, todo_id):
+        with self._lock:
+            return self._flushing.get(todo_id)
+
+    def take(self):
+        """Take all entries for a flush."""
+        with self._lock:
+            batch, self._pending = self._pending, {}
+            self._flushing.update(
+                (todo_id, entry["version"]) for todo_id, entry in batch.items()
+            )
+            return batch
+
+    def done(self, batch):
+        """The flush of the batch is committed."""
+        with self._lock:
+            for todo_id in batch:
+                self._flushing.pop(todo_id, None)
+
+    def requeue(self, batch):
+        # newer edits win over the requeued ones, the edits stay based on the
+        # version of the requeued entry
+        with self._lock:
+            for todo_id, entry in batch.items():
+                newer = self._pending.get(todo_id)
+                if newer:
+                    entry["fields"].update(newer["fields"])
+                self._pending[todo_id] = entry
+
+
+class RedisStorage:
+    """Pending edits in a redis hash, shared by all workers, see
+    MemoryStorage for the methods.
+    """
+
+    shared = True
+
+    # entries being flushed are marked for this long at most, in case the
+    # worker flushing them dies
+    FLUSHING_TTL = 30
+
+    PUT_SCRIPT = """
+    local version = tonumber(ARGV[2])
+    local raw = redis.call('HGET', KEYS[1], ARGV[1])
+    local entry
+    if raw then
+        entry = cjson.decode(raw)
+        if version ~= entry.version + 1 then
+            return {-1, redis.call('HLEN', KEYS[1])}
+        end
+    elseif ARGV[3] == '1' then
+        entry = {version = version, fields = {}}
+    else
+        return {0, redis.call('HLEN', KEYS[1])}
+    end
+    for name, value in pairs(cjson.decode(ARGV[4])) do
+        entry.fields[name] = value
+    end
+    redis.call('HSET', KEYS[1], ARGV[1], cjson.encode(entry))
+    return {entry.version + 1, redis.call('HLEN', KEYS[1])}
+    """
+
+    TAKE_SCRIPT = """
+    local all = redis.call('HGETALL', KEYS[1])
+    if #all == 0 then
+        return all
+    end
+    redis.call('DEL', KEYS[1])
+    for i = 1, #all, 2 do
+        redis.call('HSET', KEYS[2], all[i], cjson.decode(all[i + 1]).version)
+    end
+    redis.call('EXPIRE', KEYS[2], ARGV[1])
+    return all
+    """
+
+    REQUEUE_SCRIPT = """
+    for i = 1, #ARGV, 2 do
+        local entry = cjson.decode(ARGV[i + 1])
+        local raw = redis.call('HGET', KEYS[1], ARGV[i])
+        if raw then
+            for name, value in pairs(cjson.decode(raw).fields) do
+                entry.fields[name] = value
+            end
+        end
+        redis.call('HSET', KEYS[1], ARGV[i], cjson.encode(entry))
+    end
+    """
+
+    def __init__(self, url, prefix):
+        # import here so that redis is only needed when this storage is used
+        import redis
+
+        self.redis = redis.Redis.from_url(url, decode_responses=True)
+        self.pending_key = f"{prefix}:pending"
+        self.flushing_key = f"{prefix}:flushing"
+        self._put = self.redis.register_script(self.PUT_SCRIPT)
+        self._take = self.redis.register_script(self.TAKE_SCRIPT)
+        self._requeue = self.redis.register_script(self.REQUEUE_SCRIPT)
+
+    def put(self, todo_id, fields, version, create):
+        return tuple(
+            self._put(
+                keys=[self.pending_key],
+                args=[todo_id, version, int(create), json.dumps(fields)],
+            )
+        )
+
+    def pending(self):
+        return {
+            todo_id: json.loads(raw)
+            for todo_id, raw in self.redis.hgetall(self.pending_key).items()
+        }
+
+    def discard(self, todo_id):
+        with self.redis.pipeline() as pipe:
+            raw, _ = (
+                pipe.hget(self.pending_key, todo_id)
+                .hdel(self.pending_key, todo_id)
+                .execute()
+            )
+        return json.loads(raw) if raw else None
+
+    def flushing(self, todo_id):
+        version = self.redis.hget(self.flushing_key, todo_id)
+        return int(version) if version is not None else None
+
+    def take(self):
+        flat = self._take(
+            keys=[self.pending_key, self.flushing_key], args=[self.FLUSHING_TTL]
+        )
+        return {flat[i]: json.loads(flat[i + 1]) for i in range(0, len(flat), 2)}
+
+    def done(self, batch):
+        if batch:
+            self.redis.hdel(self.flushing_key, *batch)
+
+    def requeue(self, batch):
+        args = []
+        for todo_id, entry in batch.items():
+            args += [todo_id, json.dumps(entry)]
+        self._requeue(keys=[self.pending_key], args=args)
+
+
+class WriteBehindBuffer:
+    def __init__(self, app, storage, interval, max_pending):
+        self.app = app
+        self.storage = storage
+        self.interval = interval
+        self.max_pending = max_pending
+        # one flush at a time, the timer and shutdown may race
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    def put(self, todo_id, fields, version):
+        """Buffer edits of a todo the client has seen at `version`, must be
+        called in a request.
+
+        Returns the version the todo will have after the flush, or None if
+        `version` is stale.
+        """
+        new_version, count = self.storage.put(todo_id, fields, version, False)
+        if new_version == MISSING:
+            if not self._is_current(todo_id, version):
+                return None
+            new_version, count = self.storage.put(todo_id, fields, version, True)
+        if new_version == CONFLICT:
+            return None
+
+        # the flusher thread is started on first use, so that it runs in
+        # the (forked) process that serves requests
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="todo-write-behind", daemon=True
+                )
+                self._thread.start()
+        if count >= self.max_pending:
+            self._wake.set()
+        return new_version
+
+    def pending(self):
+        """The edits not flushed yet, todo id -> edited fields and the version
+        the todo will have after the flush.
+        """
+        return {
+            todo_id: {**entry["fields"], "version": entry["version"] + 1}
+            for todo_id, entry in self.storage.pending().items()
+        }
+
+    def discard(self, todo_id):
+        """Drop the edits of a todo not flushed yet and return them, or None."""
+        return self.storage.discard(todo_id)
+
+    def restore(self, todo_id, entry):
+        """Put back edits taken with `discard()`, under any newer edits."""
+        self.storage.requeue({todo_id: entry})
+
+    def flush(self):
+        """Write all pending edits in one transaction, returns the number of
+        todos flushed.
+        """
+        with self._flush_lock:
+            batch = self.storage.take()
+            if not batch:
+                return 0
+
+            try:
+                with self.app.app_context():
+                    try:
+                        rows = self._write(batch)
+                    except Exception as e:
+                        db.session.rollback()
+                        LOG.error(
+                            f"failed to flush {len(batch)} buffered todo edits, "
+                            f"retrying them one todo at a time"
+                        )
+                        LOG.error(e)
+                        rows = self._write_each(batch)
+                    flushed = self._settle(batch, rows)
+            finally:
+                self.storage.done(batch)
+
+            LOG.debug(f"flushed {flushed} of {len(batch)} buffered todo edits")
+            return flushed
+
+    def close(self):
+        """Stop the flusher and flush what is left."""
+        self._stopped.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval + 5)
+        self.flush()
+        left = len(self.storage.pending())
+        if left and self.storage.shared:
+            LOG.warning(f"left {left} buffered todo edits for the other workers")
+        elif left:
+            LOG.error(f"lost {left} buffered todo edits")
+
+    def _is_current(self, todo_id, version):
+        # a todo being flushed gets the next version of the flushed edits,
+        # checked first, as the flush may commit right after
+        flushing = self.storage.flushing(todo_id)
+        if flushing is not None:
+            return version == flushing + 1
+        current = db.session.scalar(select(Todo.version).where(Todo.id == todo_id))
+        return current == version
+
+    def _write(self, batch):
+        """Write the edits, returns the todos as they are after the writes."""
+        # one executemany UPDATE per combination of edited fields, each row
+        # is only written if the todo still has the version the edits are
+        # based on
+        groups = {}
+        for todo_id, entry in batch.items():
+            fields = entry["fields"]
+            groups.setdefault(tuple(sorted(fields)), []).append(
+                {
+                    "b_id": todo_id,
+                    "b_version": entry["version"],
+                    **{f"b_{f}": v for f, v in fields.items()},
+                }
+            )
+
+        table = Todo.__table__
+        for names, params in groups.items():
+            stmt = (
+                update(table)
+                .where(
+                    table.c.id == bindparam("b_id"),
+                    table.c.version == bindparam("b_version"),
+                )
+                .values(
+                    {
+                        **{name: bindparam(f"b_{name}") for name in names},
+                        "version": table.c.version + 1,
+                    }
+                )
+            )
+            db.session.execute(stmt, params)
+
+        # the rowcount of an executemany is not reliable on every driver
+        # (psycopg2 runs it in pages), read back which edits were written in
+        # the same transaction instead
+        rows = db.session.execute(
+            select(table.c.id, table.c.version, table.c.title, table.c.complete).where(
+                table.c.id.in_(list(batch))
+            )
+        ).all()
+        db.session.commit()
+        return rows
+
+    def _write_each(self, batch):
+        """Write the edits of each todo in its own transaction, so that one
+        bad row does not hold back the others.
+        """
+        rows = []
+        for todo_id, entry in batch.items():
+            try:
+                rows += self._write({todo_id: entry})
+            except OperationalError as e:
+                # the db is unavailable, not a problem of this row
+                db.session.rollback()
+                LOG.error(e)
+                self.storage.requeue({todo_id: entry})
+            except Exception as e:
+                db.session.rollback()
+                LOG.error(f"dropped buffered edits of todo [{todo_id}]: {e}")
+        return rows
+
+    def _settle(self, batch, rows):
+        """Publish the flushed todos, log the edits that lost, returns the
+        number of todos flushed.
+        """
+        flushed = 0
+        for row in rows:
+            entry = batch[row.id]
+            if row.version == entry["version"] + 1 and all(
+                getattr(row, f) == v for f, v in entry["fields"].items()
+            ):
+                flushed += 1
+            else:
+                LOG.warning(
+                    f"dropped buffered edits of todo [{row.id}], "
+                    f"it was changed by someone else"
+                )
+            # open pages show the edits when they are flushed, or get the
+            # todo back as it is when they were dropped
+            events.publish(
+                {
+                    "type": "updated",
+                    "id": row.id,
+                    "title": row.title,
+                    "complete": row.complete,
+                    "version": row.version,
+                }
+            )
+        return flushed
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+
+
+def init_app(app: Flask):
+    if not app.config["TODO_WRITE_BEHIND"]:
+        return
+
+    url = app.config.get("TODO_WRITE_BEHIND_URL")
+    if url:
+        storage = RedisStorage(url, app.config["TODO_WRITE_BEHIND_KEY_PREFIX"])
+        app.logger.info(f"todo write-behind uses redis storage: {url}")
+    else:
+        storage = MemoryStorage()
+        app.logger.info(
+            "todo write-behind uses per-process memory storage, "
+            "edits of a todo are only coalesced by the same worker"
+        )
+
+    buffer = WriteBehindBuffer(
+        app,
+        storage,
+        app.config["TODO_WRITE_BEHIND_INTERVAL"],
+        app.config["TODO_WRITE_BEHIND_MAX_PENDING"],
+    )
+    app.extensions["todo_write_behind"] = buffer
+    atexit.register(buffer.close)
+    app.logger.info(
+        f"todo write-behind enabled, flushing every "
+        f"{buffer.interval}s or at {buffer.max_pending} pending todos"
+    )